@@ -0,0 +1,258 @@
+"""Benchmarks
+
+This module generates synthetic donations in the FEC format and measures
+the running time of the analysis on them. It is not part of the pipeline
+run by run.sh, it only serves to compare different ways of running it.
+
+
+Example:
+        $ python benchmark.py sinks 200000
+
+"""
+
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import hot_buckets
+import output_sinks
+import pipeline
+import record_filter
+import repeated_donor_analysis as ra
+
+
+def generate_input(input_file_path, lines, seed=0, repeated=0.0):
+    """ Writes a file with random donations in the FEC format
+
+    Donors, recipients and zip codes are drawn from small pools, so that a
+    good share of the donations comes from repeated donors. A share of
+    repeated lines repeats one of the last 1000 lines with the same TRAN_ID,
+    half of them as an amendment with a new amount.
+
+    Args:
+        input_file_path (string): A string with the path to the generated file
+        lines (int): number of donations in the file
+        seed (int): seed of the random number generator
+        repeated (float): share of lines that repeat an earlier transaction
+
+    Return:
+
+    """
+    rand = random.Random(seed)
+    recipients = ['C%08d' % index for index in range(200)]
+    zip_codes = ['%05d%04d' % (rand.randrange(100000), rand.randrange(10000)) for _ in range(2000)]
+    recent = []
+    with open(input_file_path, 'w') as input_file:
+        for index in range(lines):
+            if recent and repeated and rand.random() < repeated:
+                fields = list(rand.choice(recent))
+                if rand.random() < 0.5:
+                    fields[1] = 'A'
+                    fields[14] = str(rand.randint(1, 2000))
+                input_file.write('|'.join(fields) + '\n')
+                continue
+            fields = [''] * 21
+            fields[0] = rand.choice(recipients)
+            donor = rand.randrange(lines // 4 + 1)
+            fields[7] = 'DONOR, NUMBER%d' % donor
+            fields[10] = zip_codes[donor % len(zip_codes)]
+            fields[13] = '%02d%02d%d' % (rand.randint(1, 12), rand.randint(1, 28), rand.randint(2015, 2018))
+            fields[14] = str(rand.randint(1, 2000))
+            fields[16] = 'SA%d' % index
+            input_file.write('|'.join(fields) + '\n')
+            if repeated:
+                recent.append(fields)
+                if len(recent) > 1000:
+                    recent.pop(0)
+
+
+def run(input_file_path, percentile_file_path, output_file_path, sink=None, record_filter=None,
+        deduplicate=False):
+    """ Runs process_file on fresh data structures and returns the elapsed time in seconds"""
+    ra.reset()
+    start = time.perf_counter()
+    ra.process_file(input_file_path, percentile_file_path, output_file_path, sink, record_filter,
+                    deduplicate)
+    return time.perf_counter() - start
+
+
+def load_text_into_sqlite(text_file_path, database_path):
+    """ Parses the pipe-delimited output and inserts it into SQLite, the way a downstream loader would"""
+    sink = output_sinks.SQLiteSink(database_path)
+    with open(text_file_path) as text_file:
+        for line in text_file:
+            fields = line.rstrip('\n').split('|')
+            sink.write(output_sinks.Record(fields[0], fields[1], int(fields[2]), int(fields[3]),
+                                           int(fields[4]), int(fields[5])))
+    sink.close()
+
+
+def benchmark_sinks(directory, lines):
+    """ Measures the time from raw input to a queryable table for every sink"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    generate_input(input_file_path, lines)
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+
+    text_path = os.path.join(directory, 'out.txt')
+    elapsed = run(input_file_path, percentile_file_path, text_path)
+    start = time.perf_counter()
+    load_text_into_sqlite(text_path, os.path.join(directory, 'reparsed.db'))
+    print('text + re-parse into sqlite: %.2fs' % (elapsed + time.perf_counter() - start))
+
+    for output_format in ['text', 'csv', 'columnar', 'sqlite']:
+        output_file_path = os.path.join(directory, 'out.' + output_format)
+        sink = output_sinks.make_sink(output_format, output_file_path)
+        print('%s sink: %.2fs' % (output_format, run(input_file_path, percentile_file_path,
+                                                     output_file_path, sink)))
+    connection = sqlite3.connect(os.path.join(directory, 'out.sqlite'))
+    rows = connection.execute('SELECT COUNT(*) FROM repeat_donors').fetchone()[0]
+    connection.close()
+    print('rows in table: %d' % rows)
+
+    print('iterator sink: %.2fs' % run(input_file_path, percentile_file_path, None,
+                                       output_sinks.IteratorSink(lambda record: None)))
+
+
+def benchmark_startup(directory, jobs):
+    """ Measures the latency of small jobs started as new processes and sent to a persistent worker"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    output_file_path = os.path.join(directory, 'out.txt')
+    socket_path = os.path.join(directory, 'worker.sock')
+    generate_input(input_file_path, 100)
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    arguments = [input_file_path, percentile_file_path, output_file_path]
+
+    start = time.perf_counter()
+    for _ in range(jobs):
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    print('interpreter start: %.1fms per job' % ((time.perf_counter() - start) / jobs * 1000))
+
+    start = time.perf_counter()
+    for _ in range(jobs):
+        subprocess.run([sys.executable, cli, 'run'] + arguments, check=True, stdout=subprocess.DEVNULL)
+    print('cold start (cli.py run): %.1fms per job' % ((time.perf_counter() - start) / jobs * 1000))
+
+    worker = subprocess.Popen([sys.executable, cli, 'serve', socket_path], stdout=subprocess.DEVNULL)
+    import cli as client
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    job = client.job_from_arguments(arguments)
+    start = time.perf_counter()
+    for _ in range(jobs):
+        client.submit(socket_path, job)
+    print('persistent worker: %.1fms per job' % ((time.perf_counter() - start) / jobs * 1000))
+    client.submit(socket_path, {'command': 'shutdown'})
+    worker.wait()
+
+
+def benchmark_filter(directory, lines):
+    """ Compares a full run with runs whose filter selects about 1% of the donations"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    generate_input(input_file_path, lines)
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+
+    filters = [('no filter', None),
+               ('2 of 200 committees', record_filter.RecordFilter(cmte_ids=['C00000000', 'C00000001'])),
+               ('zip prefix 42', record_filter.RecordFilter(zip_prefixes=['42']))]
+    for name, selection in filters:
+        sink = output_sinks.IteratorSink(lambda record: None)
+        print('%s: %.2fs' % (name, run(input_file_path, percentile_file_path, None, sink, selection)))
+
+
+def benchmark_pipeline(directory, lines):
+    """ Compares the sequential process_file with the pipeline for a few settings"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    output_file_path = os.path.join(directory, 'out.txt')
+    generate_input(input_file_path, lines)
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+
+    print('sequential: %.2fs' % run(input_file_path, percentile_file_path, output_file_path))
+    for parser_workers, batch_size in [(1, 2000), (2, 2000), (4, 500)]:
+        ra.reset()
+        metrics = pipeline.process_file(input_file_path, percentile_file_path, output_file_path,
+                                        parser_workers=parser_workers, batch_size=batch_size)
+        print('pipeline with %d parsers, batches of %d lines: %s' % (
+            parser_workers, batch_size, pipeline.format_metrics(metrics)))
+
+
+def benchmark_deduplicate(directory, lines):
+    """ Measures the running time and the memory of the transaction index"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    generate_input(input_file_path, lines, repeated=0.05)
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+
+    for deduplicate in [False, True]:
+        sink = output_sinks.IteratorSink(lambda record: None)
+        elapsed = run(input_file_path, percentile_file_path, None, sink, None, deduplicate)
+        print('deduplicate=%s: %.2fs, %d amounts in recipients' % (
+            deduplicate, elapsed, sum(len(amounts) for amounts in ra.recipients.values())))
+    size = sys.getsizeof(ra.transactions)
+    for key, counted in ra.transactions.items():
+        size += sys.getsizeof(key) + (sys.getsizeof(counted) if counted is not None else 0)
+    print('transaction index: %d transactions, %.1f MB, %.0f bytes per transaction' % (
+        len(ra.transactions), size / 1e6, size / max(len(ra.transactions), 1)))
+
+
+def benchmark_hot_buckets(directory, lines):
+    """ Compares sorted lists and hot buckets when all donations go to one recipient from one zip code"""
+    input_file_path = os.path.join(directory, 'itcont.txt')
+    percentile_file_path = os.path.join(directory, 'percentile.txt')
+    rand = random.Random(0)
+    with open(input_file_path, 'w') as input_file:
+        for index in range(lines):
+            fields = [''] * 21
+            fields[0] = 'C00401224'
+            fields[7] = 'DONOR, NUMBER%d' % rand.randrange(lines // 4 + 1)
+            fields[10] = '20001'
+            fields[13] = '0101%d' % rand.randint(2015, 2018)
+            fields[14] = str(rand.randint(1, 2000))
+            input_file.write('|'.join(fields) + '\n')
+    with open(percentile_file_path, 'w') as percentile_file:
+        percentile_file.write('30\n')
+
+    promotion_size = hot_buckets.PROMOTION_SIZE
+    for name, size in [('sorted lists only', lines + 1), ('hot buckets', promotion_size)]:
+        hot_buckets.PROMOTION_SIZE = size
+        latencies = []
+        last = [time.perf_counter()]
+
+        def measure(record):
+            now = time.perf_counter()
+            latencies.append(now - last[0])
+            last[0] = now
+        elapsed = run(input_file_path, percentile_file_path, None, output_sinks.IteratorSink(measure))
+        latencies.sort()
+        print('%s: %.2fs, time between output lines p50 %.0fus, p99 %.0fus, max %.0fus, %s' % (
+            name, elapsed, latencies[len(latencies) // 2] * 1e6, latencies[len(latencies) * 99 // 100] * 1e6,
+            latencies[-1] * 1e6, ra.bucket_stats))
+    hot_buckets.PROMOTION_SIZE = promotion_size
+
+
+benchmarks = {'sinks': benchmark_sinks, 'startup': benchmark_startup, 'filter': benchmark_filter,
+              'pipeline': benchmark_pipeline, 'deduplicate': benchmark_deduplicate,
+              'hot_buckets': benchmark_hot_buckets}
+# The startup benchmark counts jobs, each of them starts an interpreter, the others count lines
+defaults = {'startup': 100}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in benchmarks:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmarks[sys.argv[1]](directory, int(sys.argv[2]) if len(sys.argv) > 2
+                                    else defaults.get(sys.argv[1], 200000))
+    else:
+        print("Usage: python benchmark.py [" + '|'.join(sorted(benchmarks)) + "] [lines|jobs]")
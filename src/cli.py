@@ -0,0 +1,215 @@
+"""Command Line Entry Point
+
+This module is a lean entry point for running the analysis many times, for
+instance once per committee. It only imports what the selected mode needs,
+so starting it is cheap. There are three modes:
+
+    run:    analyses a single file, like repeated_donor_analysis.py
+    serve:  starts a persistent worker listening on a local (unix) socket.
+            The worker loads and warms up the analysis once and then
+            processes one job after the other.
+    submit: sends a job to a running worker and waits for its answer.
+            This mode never loads the analysis itself.
+
+A job is a single line of JSON with the keys input, percentile, output and
+optionally format (see output_sinks), filter, an object with the
+arguments of record_filter.RecordFilter, and deduplicate (true to skip
+repeated rows of a transaction). The worker answers with a single line
+of JSON that contains the status of the job, its running time in seconds
+and ra.bucket_stats, the number of promoted buckets and outliers (see hot_buckets).
+Sending {"command": "shutdown"} stops the worker.
+
+
+Example:
+        $ python cli.py serve /tmp/donors.sock &
+        $ python cli.py submit /tmp/donors.sock input_file percentile_file output_file [format]
+
+"""
+
+import sys
+
+# Seconds the worker waits for a client to send its job or read the answer
+CONNECTION_TIMEOUT = 10
+
+
+def main():
+    """ Dispatches the command line arguments to the selected mode
+
+    run and submit exit with status 1 if the job failed, so that a
+    scheduler can detect it.
+
+    Args:
+
+    Returns:
+
+    """
+    if len(sys.argv) > 4 and sys.argv[1] == 'run':
+        response = run_job(job_from_arguments(sys.argv[2:]))
+        if response['status'] != 'ok':
+            print(response['message'])
+            sys.exit(1)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        serve(sys.argv[2])
+    elif len(sys.argv) > 5 and sys.argv[1] == 'submit':
+        response = submit(sys.argv[2], job_from_arguments(sys.argv[3:]))
+        print(response)
+        if response['status'] != 'ok':
+            sys.exit(1)
+    else:
+        print("Usage: python cli.py run input_file percentile_file output_file [format]")
+        print("       python cli.py serve socket_path")
+        print("       python cli.py submit socket_path input_file percentile_file output_file [format]")
+
+
+def job_from_arguments(arguments):
+    """ Turns the arguments input, percentile, output and optional format into a job
+
+    The paths are made absolute, as a worker resolves relative paths against
+    its own working directory rather than the one of the submitting process.
+
+    Args:
+        arguments (list): list of 3 or 4 strings given on the command line
+
+    Return:
+        job (dict): the job with the keys input, percentile, output and format
+
+    """
+    import os
+    return {'input': os.path.abspath(arguments[0]), 'percentile': os.path.abspath(arguments[1]),
+            'output': os.path.abspath(arguments[2]),
+            'format': arguments[3] if len(arguments) > 3 else 'text'}
+
+
+def run_job(job):
+    """ Runs the analysis for a single job on fresh data structures
+
+    Args:
+        job (dict): the job with the keys input, percentile, output and
+            optionally format, filter and deduplicate
+
+    Return:
+        response (dict): status 'ok', the running time in seconds and
+            ra.bucket_stats as buckets, or status 'error' and an error message. A failing job never
+            raises, so a worker keeps serving the next jobs.
+
+    """
+    import time
+    import repeated_donor_analysis as ra
+    from output_sinks import make_sink
+    from record_filter import RecordFilter
+
+    start = time.perf_counter()
+    try:
+        record_filter = RecordFilter(**job['filter']) if 'filter' in job else None
+        sink = make_sink(job.get('format', 'text'), job['output'])
+        if sink is None:
+            return {'status': 'error', 'message': 'Unknown output format ' + job['format']}
+        ra.reset()
+        if not ra.process_file(job['input'], job['percentile'], job['output'], sink, record_filter,
+                               job.get('deduplicate', False)):
+            return {'status': 'error', 'message': 'The files could not be read/written or the '
+                                                  'percentile was not an integer'}
+        bucket_stats = dict(ra.bucket_stats)
+    except (KeyError, TypeError) as error:
+        return {'status': 'error', 'message': 'Malformed job ' + repr(error)}
+    except Exception as error:
+        return {'status': 'error', 'message': repr(error)}
+    finally:
+        # Do not keep the last job's donors alive while waiting for the next one
+        ra.reset()
+    return {'status': 'ok', 'seconds': time.perf_counter() - start, 'buckets': bucket_stats}
+
+
+def warm_up():
+    """ Loads the analysis and validates a sample line, so that the first job does not pay for it
+
+    Args:
+
+    Return:
+
+    """
+    import repeated_donor_analysis as ra
+    sample = 'C00629618|N|TER|P|1|15C|IND|PEREZ, JOHN A|LA|CA|90017|P|D|01032017|40||S|1|||2'
+    ra.is_valid(sample.split('|'))
+
+
+def serve(socket_path):
+    """ Processes jobs sent to the unix socket at socket_path until it is asked to shut down
+
+    Jobs are processed one after the other, as the analysis keeps its
+    state in module variables. Other processes can wait for socket_path
+    to exist before submitting jobs. A client that disconnects early or does
+    not send its job within CONNECTION_TIMEOUT seconds is dropped, and the
+    worker goes on with the next one.
+
+    Args:
+        socket_path (string): A string with the path of the socket file,
+            an existing file at this path is replaced
+
+    Return:
+
+    """
+    import json
+    import os
+    import socket
+
+    warm_up()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # Bind under a temporary name, the socket only appears at socket_path once it accepts jobs
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path + '.tmp')
+    server.listen()
+    os.rename(socket_path + '.tmp', socket_path)
+    try:
+        shutdown = False
+        while not shutdown:
+            connection, _ = server.accept()
+            connection.settimeout(CONNECTION_TIMEOUT)
+            try:
+                with connection, connection.makefile('rwb') as stream:
+                    try:
+                        job = json.loads(stream.readline().decode('utf-8'))
+                    except ValueError:
+                        job = None
+                    shutdown = isinstance(job, dict) and job.get('command') == 'shutdown'
+                    if shutdown:
+                        response = {'status': 'ok'}
+                    elif isinstance(job, dict):
+                        response = run_job(job)
+                    else:
+                        response = {'status': 'error', 'message': 'Job is not a JSON object'}
+                    stream.write(json.dumps(response).encode('utf-8') + b'\n')
+            except OSError:
+                # The client went away or timed out, this must not stop the worker
+                pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def submit(socket_path, job):
+    """ Sends a job to the worker listening at socket_path and returns its answer
+
+    Args:
+        socket_path (string): A string with the path of the worker's socket file
+        job (dict): the job, see run_job
+
+    Return:
+        response (dict): the worker's answer
+
+    """
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(job).encode('utf-8') + b'\n')
+        stream.flush()
+        return json.loads(stream.readline().decode('utf-8'))
+
+
+# Only run main if module is executed as main
+if __name__ == "__main__":
+    main()
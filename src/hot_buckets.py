@@ -0,0 +1,210 @@
+"""Hot Buckets
+
+This module provides HotBucket, the representation of the donations to a
+recipient from a zip code in a year once there are many of them. Large
+conduit committees collect millions of donations from a single zip code,
+where adding to the sorted list becomes the bottleneck.
+
+A HotBucket stores an exact histogram of the $-amounts and a Fenwick tree
+(binary indexed tree) over a window of dollar values. Adding or removing a
+donation and finding the donation of a given rank (which is what the
+percentile computation needs) take O(log V) time, where V is the size of the
+window. The percentiles stay exact, as every single donation is still counted.
+
+The tree has one entry per dollar value, so its memory grows with the window
+rather than with the number of donations. The window starts at the smallest
+amount when the bucket is promoted and covers at most max_size dollar
+values. Amounts outside of the window (e.g. a few very large donations) are
+kept in a sorted list of outliers instead, so a single outlier neither
+blows up the tree nor turns the bucket back into a sorted list. The window
+grows in both directions as the bucket grows, taking in the outliers it
+then covers.
+
+repeated_donor_analysis.add_amount promotes a sorted list to a HotBucket
+once it holds PROMOTION_SIZE donations.
+
+"""
+
+from sortedcontainers import SortedList
+
+# Number of donations from which a bucket is promoted, from here on the tree
+# takes at most as much memory as the sorted list (see SLOTS_PER_DONATION)
+PROMOTION_SIZE = 512
+# Largest number of dollar values the tree of a HotBucket covers
+MAX_RANGE = 1 << 14
+# Largest number of tree entries per donation, a sorted list takes about as much
+# memory per donation as a HotBucket takes for this many entries
+SLOTS_PER_DONATION = 4
+# Smallest number of dollar values the tree of a HotBucket covers
+MIN_SIZE = 1024
+
+
+def tree_size(span):
+    """ Returns the number of entries of a tree covering span dollar values
+
+    Args:
+        span (int): number of dollar values the tree has to cover
+
+    Return:
+        size (int): the smallest power of two that is at least span and MIN_SIZE
+
+    """
+    size = MIN_SIZE
+    while size < span:
+        size *= 2
+    return size
+
+
+def max_size(length):
+    """ Returns the largest number of dollar values the tree may cover for length donations
+
+    Args:
+        length (int): number of donations
+
+    Return:
+        size (int): SLOTS_PER_DONATION entries per donation, but at least
+            MIN_SIZE and at most MAX_RANGE entries
+
+    """
+    return min(MAX_RANGE, max(MIN_SIZE, SLOTS_PER_DONATION * length))
+
+
+class HotBucket:
+    """ Multiset of integer $-amounts with O(log V) insertion, removal and rank queries
+
+    It supports the operations of the sorted list that the analysis uses:
+    add, remove, len, indexing with a rank and iterating in ascending order.
+
+    Args:
+        values (iterable): the initial amounts, at least one, as integers
+
+    """
+
+    def __init__(self, values):
+        self.counts = {}
+        self.outliers = SortedList()
+        values = list(values)
+        self.length = len(values)
+        self.low = min(values)
+        size = tree_size(max(values) - self.low + 1)
+        while size > max_size(self.length) and size > MIN_SIZE:
+            size //= 2
+        self.size = size
+        for value in values:
+            if value < self.low + size:
+                self.counts[value] = self.counts.get(value, 0) + 1
+            else:
+                self.outliers.add(value)
+        self.build()
+
+    def build(self):
+        """ Rebuilds the Fenwick tree over the self.size dollar values starting at self.low"""
+        tree = [0] * (self.size + 1)
+        for value, count in self.counts.items():
+            tree[value - self.low + 1] += count
+        # Turn the counts into a Fenwick tree in linear time
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def grow(self, low, size):
+        """ Widens the tree to size dollar values starting at low and moves the outliers it now covers into it"""
+        self.low = low
+        self.size = size
+        covered = list(self.outliers.irange(self.low, self.low + size - 1))
+        for value in covered:
+            self.outliers.remove(value)
+            self.counts[value] = self.counts.get(value, 0) + 1
+        self.build()
+
+    def update(self, value, count):
+        """ Adds count to the number of donations of the given amount in the tree"""
+        index = value - self.low + 1
+        tree = self.tree
+        size = self.size
+        while index <= size:
+            tree[index] += count
+            index += index & -index
+
+    def add(self, value):
+        """ Adds a donation of the given amount
+
+        Args:
+            value (int): the $-amount
+
+        Return:
+            boolean: True if the amount was added to the tree, False if it
+                was kept as an outlier
+
+        """
+        self.length += 1
+        if value < self.low or value >= self.low + self.size:
+            low = min(self.low, value)
+            size = tree_size(max(self.low + self.size, value + 1) - low)
+            if size <= max_size(self.length):
+                self.grow(low, size)
+        if self.low <= value < self.low + self.size:
+            self.counts[value] = self.counts.get(value, 0) + 1
+            self.update(value, 1)
+            return True
+        self.outliers.add(value)
+        return False
+
+    def remove(self, value):
+        """ Removes a donation of the given amount, raises ValueError if there is none
+
+        Args:
+            value (int): the $-amount
+
+        Return:
+            No return value
+
+        """
+        if self.low <= value < self.low + self.size:
+            count = self.counts.get(value, 0)
+            if count == 0:
+                raise ValueError(str(value) + " not in bucket")
+            if count == 1:
+                del self.counts[value]
+            else:
+                self.counts[value] = count - 1
+            self.update(value, -1)
+        else:
+            self.outliers.remove(value)
+        self.length -= 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, rank):
+        """ Returns the amount at position rank (starting at 0) of the ascendingly sorted donations"""
+        if rank < 0:
+            rank += self.length
+        if rank < 0 or rank >= self.length:
+            raise IndexError("bucket index out of range")
+        below = self.outliers.bisect_left(self.low)
+        if rank < below:
+            return self.outliers[rank]
+        rank -= below
+        in_tree = self.length - len(self.outliers)
+        if rank >= in_tree:
+            return self.outliers[below + rank - in_tree]
+        # Descend the tree to the largest index whose prefix count is at most rank
+        tree = self.tree
+        index = 0
+        step = self.size
+        while step:
+            if index + step <= self.size and tree[index + step] <= rank:
+                index += step
+                rank -= tree[index]
+            step //= 2
+        return self.low + index
+
+    def __iter__(self):
+        yield from self.outliers.irange(maximum=self.low, inclusive=(True, False))
+        for value in sorted(self.counts):
+            for _ in range(self.counts[value]):
+                yield value
+        yield from self.outliers.irange(minimum=self.low + self.size)
@@ -0,0 +1,356 @@
+"""Output Sinks
+
+This module provides the destinations the results of process_file can be
+written to. Every output line of the analysis is represented as a Record,
+a typed tuple (recipient, zip-code, year, percentile value, total amount,
+number of contributions). A sink receives these records one by one through
+write and finalizes its destination in close. If the analysis fails, discard
+releases the destination instead. Sinks only open their destination once the
+first record is written or they are closed, so a sink that is never used
+does not hold on to a file or connection.
+
+The following sinks are available:
+
+    text:     the pipe-delimited format required by the challenge
+    csv:      comma separated values with a header line
+    columnar: a compact binary file storing each field as a column
+    sqlite:   a table in a local SQLite database, filled with batched inserts
+
+IteratorSink additionally hands the records straight to a consumer in the
+same process, so no file has to be written and parsed again.
+
+Example:
+        $ python repeated_donor_analysis.py input_file percentile_file output_file sqlite
+
+"""
+
+import array
+import collections
+import struct
+
+Record = collections.namedtuple('Record', ['recipient', 'zip_code', 'year',
+                                           'percentile_value', 'total_amount',
+                                           'count'])
+
+# Layout of the columnar file: magic, then row groups of the form
+# (number of rows, one block per column), terminated by a group of 0 rows
+COLUMNAR_MAGIC = b'RDCOL1\n'
+STRING_COLUMNS = ('recipient', 'zip_code')
+INTEGER_COLUMNS = ('year', 'percentile_value', 'total_amount', 'count')
+
+
+def format_record(record):
+    """ Given a record, returns the pipe-delimited output string
+
+    The output string has the format:
+    'recipient|zip-code|year|percentile_value|total_amount|number of contributions'
+
+    Args:
+        record (Record): the record to be formatted
+
+    Return:
+        line (string): the record as a line of the challenge's output format
+
+    """
+    return '|'.join([record[0], record[1], str(record[2]), str(record[3]),
+                     str(record[4]), str(record[5])])
+
+
+def make_sink(output_format, output_file_path):
+    """ Given the name of an output format and a path, returns the matching sink
+
+    Args:
+        output_format (string): one of 'text', 'csv', 'columnar' or 'sqlite'
+        output_file_path (string): A string with the path to the output file
+
+    Return:
+        sink: a sink writing to output_file_path, None if the format is unknown
+
+    """
+    sinks = {'text': TextSink, 'csv': CSVSink,
+             'columnar': ColumnarSink, 'sqlite': SQLiteSink}
+    if output_format not in sinks:
+        return None
+    return sinks[output_format](output_file_path)
+
+
+class TextSink:
+    """ Writes records in the pipe-delimited format of the challenge
+
+    The lines are collected in memory and written to the file in one go
+    when the sink is closed, which is faster than dumping lines individually.
+
+    Args:
+        output_file_path (string): A string with the path to the output file
+
+    """
+
+    def __init__(self, output_file_path):
+        self.output_file_path = output_file_path
+        self.lines = []
+
+    def write(self, record):
+        self.lines.append(format_record(record))
+        self.lines.append('\n')
+
+    def close(self):
+        with open(self.output_file_path, 'w+') as output_file:
+            output_file.write(''.join(self.lines))
+        self.lines = []
+
+    def discard(self):
+        self.lines = []
+
+
+class CSVSink:
+    """ Writes records as comma separated values, starting with a header line
+
+    Args:
+        output_file_path (string): A string with the path to the output file
+
+    """
+
+    def __init__(self, output_file_path):
+        self.output_file_path = output_file_path
+        self.output_file = None
+
+    def open(self):
+        """ Opens the output file and writes the header line"""
+        # Imported here, so that runs with other sinks do not pay for loading it
+        import csv
+        self.output_file = open(self.output_file_path, 'w', newline='')
+        self.writer = csv.writer(self.output_file)
+        self.writer.writerow(Record._fields)
+
+    def write(self, record):
+        if self.output_file is None:
+            self.open()
+        self.writer.writerow(record)
+
+    def close(self):
+        if self.output_file is None:
+            self.open()
+        self.output_file.close()
+
+    def discard(self):
+        _discard_file(self)
+
+
+class ColumnarSink:
+    """ Writes records to a binary file that stores every field as a column
+
+    Records are buffered into row groups of row_group_size rows. Each row
+    group is stored as the number of rows followed by one block per column.
+    Integer columns are stored as arrays of little-endian 64 bit integers,
+    string columns as an array of 32 bit lengths followed by the utf-8
+    encoded values. A loader can therefore read a whole column with a
+    single call instead of parsing every line. See read_columnar for
+    the matching reader.
+
+    Args:
+        output_file_path (string): A string with the path to the output file
+        row_group_size (int): number of records buffered before a row group
+            is written to the file
+
+    """
+
+    def __init__(self, output_file_path, row_group_size=65536):
+        self.output_file_path = output_file_path
+        self.output_file = None
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def open(self):
+        """ Opens the output file and writes the magic bytes"""
+        self.output_file = open(self.output_file_path, 'wb')
+        self.output_file.write(COLUMNAR_MAGIC)
+
+    def flush(self):
+        """ Writes the buffered records as one row group"""
+        if not self.rows:
+            return
+        if self.output_file is None:
+            self.open()
+        self.output_file.write(struct.pack('<I', len(self.rows)))
+        columns = list(zip(*self.rows))
+        for index, name in enumerate(Record._fields):
+            if name in STRING_COLUMNS:
+                values = [value.encode('utf-8') for value in columns[index]]
+                lengths = array.array('I', [len(value) for value in values])
+                self.output_file.write(_little_endian(lengths).tobytes())
+                self.output_file.write(b''.join(values))
+            else:
+                integers = array.array('q', columns[index])
+                self.output_file.write(_little_endian(integers).tobytes())
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.output_file is None:
+            self.open()
+        self.output_file.write(struct.pack('<I', 0))
+        self.output_file.close()
+
+    def discard(self):
+        self.rows = []
+        _discard_file(self)
+
+
+def read_columnar(input_file_path):
+    """ Reads a file written by ColumnarSink
+
+    Args:
+        input_file_path (string): A string with the path to the columnar file
+
+    Return:
+        columns (dict): maps every field name of Record to the list of its values
+
+    """
+    columns = {name: [] for name in Record._fields}
+    with open(input_file_path, 'rb') as input_file:
+        if input_file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("Not a columnar output file")
+        while True:
+            rows = struct.unpack('<I', input_file.read(4))[0]
+            if rows == 0:
+                break
+            for name in Record._fields:
+                if name in STRING_COLUMNS:
+                    lengths = array.array('I')
+                    lengths.frombytes(input_file.read(4 * rows))
+                    data = input_file.read(sum(_little_endian(lengths)))
+                    position = 0
+                    for length in lengths:
+                        columns[name].append(data[position:position + length].decode('utf-8'))
+                        position += length
+                else:
+                    integers = array.array('q')
+                    integers.frombytes(input_file.read(8 * rows))
+                    columns[name].extend(_little_endian(integers))
+    return columns
+
+
+def _discard_file(sink):
+    """ Closes the sink's output file, if it was opened, and removes the incomplete file"""
+    if sink.output_file is not None:
+        import os
+        sink.output_file.close()
+        sink.output_file = None
+        os.remove(sink.output_file_path)
+
+
+def _little_endian(values):
+    """ Returns the array in little-endian byte order, swapping it in place if needed"""
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        values.byteswap()
+    return values
+
+
+class SQLiteSink:
+    """ Inserts records into a table of a local SQLite database
+
+    Records are buffered and inserted batch_size at a time via executemany.
+    The whole run is a single transaction that is committed when the sink
+    is closed, so the database does not have to sync to disk for every row.
+    Once the sink is closed, the table can be queried right away. A discarded
+    sink rolls the transaction back, which leaves the table as it was before
+    the run.
+
+    Args:
+        output_file_path (string): A string with the path to the database file
+        table (string): name of the table the records are inserted into,
+            it is created if it does not exist
+        batch_size (int): number of records buffered per executemany
+        replace (boolean): if True, an existing table is dropped first, so the
+            table holds the results of this run only (just like the text
+            format overwrites its file). If False, the records are appended.
+
+    """
+
+    def __init__(self, output_file_path, table='repeat_donors', batch_size=10000, replace=True):
+        self.output_file_path = output_file_path
+        self.connection = None
+        self.table = table
+        self.batch_size = batch_size
+        self.replace = replace
+        self.rows = []
+        self.insert = 'INSERT INTO ' + table + ' VALUES (?, ?, ?, ?, ?, ?)'
+
+    def open(self):
+        """ Connects to the database and creates the table, dropping an existing one if replace is set"""
+        # Imported here, so that runs with other sinks do not pay for loading it
+        import sqlite3
+        # Manage the transaction ourselves, so that dropping the table is part of it
+        self.connection = sqlite3.connect(self.output_file_path, isolation_level=None)
+        self.connection.execute('BEGIN')
+        if self.replace:
+            self.connection.execute('DROP TABLE IF EXISTS ' + self.table)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS ' + self.table + ' (recipient TEXT, zip_code TEXT, '
+            'year INTEGER, percentile_value INTEGER, total_amount INTEGER, count INTEGER)')
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Inserts the buffered records into the open transaction"""
+        if not self.rows:
+            return
+        if self.connection is None:
+            self.open()
+        self.connection.executemany(self.insert, self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.connection is None:
+            self.open()
+        self.connection.execute('COMMIT')
+        self.connection.close()
+
+    def discard(self):
+        self.rows = []
+        if self.connection is not None:
+            self.connection.rollback()
+            self.connection.close()
+            self.connection = None
+
+
+class IteratorSink:
+    """ Passes records straight to a downstream consumer
+
+    If a consumer is given, it is called with every record as soon as it is
+    produced. Otherwise the records are queued and the sink can be iterated
+    over, which drains the queue.
+
+    Args:
+        consumer (callable): optional function that is called with each record
+
+    """
+
+    def __init__(self, consumer=None):
+        self.consumer = consumer
+        self.records = collections.deque()
+
+    def write(self, record):
+        if self.consumer is not None:
+            self.consumer(record)
+        else:
+            self.records.append(record)
+
+    def close(self):
+        pass
+
+    def discard(self):
+        pass
+
+    def __iter__(self):
+        while self.records:
+            yield self.records.popleft()
@@ -0,0 +1,341 @@
+"""Pipelined Processing
+
+This module runs the same analysis as repeated_donor_analysis.process_file,
+but splits it into stages that run in their own threads:
+
+    reader:     reads the input file in large blocks and cuts it into
+                batches of lines
+    parsers:    split, filter and validate the lines of a batch and extract
+                the donations (several workers)
+    aggregator: applies add_donor and add_recipients in the original order
+                of the lines and computes the output records
+    writer:     drains the records into the sink
+
+The stages are connected by bounded queues, so a fast stage blocks instead
+of piling up data in memory. Each queue keeps track of how many batches are
+waiting in it (see MeteredQueue). A queue that is usually full belongs to a
+stage that can not keep up, a queue that is usually empty belongs to a stage
+that waits for its input.
+
+Note that CPython only runs one thread at a time for pure Python code, so
+the parser workers mostly help to overlap the file reads and writes with
+the CPU work rather than to parse in parallel.
+
+
+Example:
+        >>> metrics = process_file('itcont.txt', 'percentile.txt', 'repeat_donors.txt')
+        >>> print(format_metrics(metrics))
+
+"""
+
+import queue
+import threading
+import time
+
+import repeated_donor_analysis as ra
+from output_sinks import TextSink
+from record_filter import SKIP, DONOR_ONLY, KEEP
+
+# Marks the end of the batches in a queue
+DONE = None
+
+
+class MeteredQueue(queue.Queue):
+    """ A queue.Queue that samples its depth every time an item is put into it
+
+    Args:
+        maxsize (int): number of items after which put blocks
+
+    """
+
+    def __init__(self, maxsize):
+        queue.Queue.__init__(self, maxsize)
+        self.puts = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.full = 0
+
+    def _put(self, item):
+        # Called by put while holding the queue's lock, so the counters are consistent
+        depth = len(self.queue)
+        self.puts += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        if depth + 1 >= self.maxsize:
+            self.full += 1
+        queue.Queue._put(self, item)
+
+    def metrics(self):
+        """ Returns the depth statistics of the queue
+
+        Return:
+            metrics (dict): number of puts, mean and maximal depth seen by a put
+                and the fraction of puts that filled the queue up
+
+        """
+        puts = max(self.puts, 1)
+        return {'puts': self.puts, 'mean_depth': self.total_depth / puts,
+                'max_depth': self.max_depth, 'full': self.full / puts}
+
+
+def process_file(input_file_path, percentile_file_path, output_file_path, sink=None,
+                 record_filter=None, deduplicate=False, block_size=1 << 20, batch_size=2000,
+                 parser_workers=2, queue_size=8):
+    """ Computes the same output as repeated_donor_analysis.process_file with a pipeline of threads
+
+    The results are accumulated in the module variables of
+    repeated_donor_analysis, just like in the sequential version.
+
+    Args:
+        input_file_path (string): A string with the path to the input file
+        percentile_file_path (string): A string with the path to the
+            file that contains the percentile value
+        output_file_path (string): A string with the path to the output file
+        sink: optional sink from output_sinks that receives the records,
+            a TextSink writing to output_file_path is used if none is given.
+            It is closed once all records are written, or discarded if the
+            analysis fails.
+        record_filter (RecordFilter): optional filter restricting the
+            donations that are reported on, see record_filter
+        deduplicate (boolean): if True, repeated rows of a transaction are
+            skipped and amendments replace the transaction's earlier amount
+        block_size (int): number of characters the reader reads at once
+        batch_size (int): number of lines in a batch handed to a parser
+        parser_workers (int): number of parser threads
+        queue_size (int): number of batches each queue holds before it blocks
+
+    Return:
+        metrics (dict): maps the name of each stage's input queue to its
+            depth statistics, and 'seconds' to the total running time.
+            None if the files could not be read or written.
+
+    """
+    start = time.perf_counter()
+    if sink is None:
+        sink = TextSink(output_file_path)
+    try:
+        percentile = ra.read_percentile(percentile_file_path)
+        if percentile is None:
+            sink.discard()
+            return None
+        input_file = open(input_file_path, 'r')
+    except IOError:
+        print("There was an error reading/writing the files.")
+        sink.discard()
+        return None
+
+    queues = {'parse': MeteredQueue(queue_size), 'aggregate': MeteredQueue(queue_size),
+              'write': MeteredQueue(queue_size)}
+    abort = threading.Event()
+    errors = []
+
+    def stage(target, *args):
+        # Runs a stage, on an error all other stages are told to stop
+        def run():
+            try:
+                target(*args)
+            except BaseException as error:
+                errors.append(error)
+                abort.set()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    threads = [stage(read, input_file, queues['parse'], block_size, batch_size,
+                     parser_workers, abort)]
+    for _ in range(parser_workers):
+        threads.append(stage(parse, queues['parse'], queues['aggregate'], record_filter,
+                             deduplicate, abort))
+    threads.append(stage(write, queues['write'], sink, abort))
+    aggregator = stage(aggregate, queues['aggregate'], queues['write'], percentile,
+                       parser_workers, abort)
+    aggregator.join()
+    for thread in threads:
+        thread.join()
+    input_file.close()
+
+    if errors:
+        # The writer only closes the sink if all stages succeeded
+        sink.discard()
+        if isinstance(errors[0], IOError):
+            print("There was an error reading/writing the files.")
+            return None
+        raise errors[0]
+    metrics = {name: metered.metrics() for name, metered in queues.items()}
+    metrics['seconds'] = time.perf_counter() - start
+    return metrics
+
+
+def put(target, item, abort):
+    """ Puts item into the queue target, gives up once abort is set
+
+    Return:
+        boolean: True if the item was put into the queue, False if aborted
+
+    """
+    while not abort.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(source, abort):
+    """ Takes the next item from the queue source, returns DONE once abort is set"""
+    while not abort.is_set():
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return DONE
+
+
+def read(input_file, parse_queue, block_size, batch_size, parser_workers, abort):
+    """ Reader stage: cuts the input file into numbered batches of lines
+
+    The file is read block_size characters at a time. The incomplete line at
+    the end of a block is kept and completed with the next block. Every batch
+    is put into parse_queue together with its number, followed by one DONE
+    for every parser worker.
+
+    """
+    number = 0
+    rest = ''
+    batch = []
+    while True:
+        block = input_file.read(block_size)
+        if not block:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        batch.extend(lines)
+        # Walk through the buffered lines and only copy the leftover once per block
+        start = 0
+        while len(batch) - start >= batch_size:
+            if not put(parse_queue, (number, batch[start:start + batch_size]), abort):
+                return
+            number += 1
+            start += batch_size
+        batch = batch[start:]
+    if rest:
+        batch.append(rest)
+    if batch and not put(parse_queue, (number, batch), abort):
+        return
+    for _ in range(parser_workers):
+        if not put(parse_queue, DONE, abort):
+            return
+
+
+def parse(parse_queue, aggregate_queue, record_filter, deduplicate, abort):
+    """ Parser stage: turns a batch of lines into the donations the aggregator has to apply
+
+    For every batch, a list of triples (report, donation, transaction) is put
+    into aggregate_queue, where donation is the extracted entry, report is
+    False if the donation only counts towards the donor's earliest donation
+    and transaction is the result of transaction_of (None without deduplicate).
+    Amendments outside of the filter are passed on as (False, None, transaction),
+    so the aggregator can take back the transaction's earlier amount.
+    Once the reader is done, DONE is passed on.
+
+    """
+    while True:
+        item = get(parse_queue, abort)
+        if item is DONE:
+            put(aggregate_queue, DONE, abort)
+            return
+        number, lines = item
+        donations = []
+        for line in lines:
+            entry = line.split('|')
+            report = True
+            if record_filter is not None:
+                action = record_filter.classify(entry)
+                if deduplicate and action != KEEP:
+                    amendment = ra.amendment_of(entry)
+                    if amendment is not None:
+                        donations.append((False, None, amendment))
+                if action == SKIP:
+                    continue
+                if action == DONOR_ONLY:
+                    # repeat_donors is read while the aggregator changes it. It only ever
+                    # gains donors and earlier years and the aggregator has not reached this
+                    # batch yet, so a line that does not need an update now will not later.
+                    if not ra.needs_donor_update(entry):
+                        continue
+                    report = False
+            if ra.is_valid(entry):
+                transaction = ra.transaction_of(entry) if deduplicate and report else None
+                donations.append((report, ra.extract(entry), transaction))
+        if not put(aggregate_queue, (number, donations), abort):
+            return
+
+
+def aggregate(aggregate_queue, write_queue, percentile, parser_workers, abort):
+    """ Aggregator stage: applies the donations of the batches in their original order
+
+    Batches that arrive ahead of their turn are held back until all earlier
+    batches have been applied. The output records of each batch are put
+    into write_queue, followed by DONE once all parsers are done.
+
+    """
+    waiting = {}
+    next_number = 0
+    running = parser_workers
+    while running:
+        item = get(aggregate_queue, abort)
+        if abort.is_set():
+            return
+        if item is DONE:
+            running -= 1
+            continue
+        waiting[item[0]] = item[1]
+        while next_number in waiting:
+            records = []
+            for report, donation, transaction in waiting.pop(next_number):
+                if donation is None:
+                    ra.withdraw_transaction(transaction)
+                    continue
+                if not ra.add_transaction(transaction):
+                    continue
+                ra.add_donor(donation)
+                if report:
+                    recipient_key = ra.add_recipients(donation)
+                    ra.record_transaction(transaction, recipient_key, donation[4])
+                    if recipient_key is not None:
+                        records.append(ra.summarize(percentile, recipient_key))
+            next_number += 1
+            if records and not put(write_queue, records, abort):
+                return
+    put(write_queue, DONE, abort)
+
+
+def write(write_queue, sink, abort):
+    """ Writer stage: writes the records to the sink and closes it once the aggregator is done"""
+    while True:
+        records = get(write_queue, abort)
+        if records is DONE:
+            break
+        for record in records:
+            sink.write(record)
+    if not abort.is_set():
+        sink.close()
+
+
+def format_metrics(metrics):
+    """ Given the metrics returned by process_file, returns a readable summary
+
+    Args:
+        metrics (dict): the metrics returned by process_file
+
+    Return:
+        summary (string): one line per queue with its depth statistics
+
+    """
+    lines = ['%.2fs' % metrics['seconds']]
+    for name in ['parse', 'aggregate', 'write']:
+        lines.append('%-9s queue: mean depth %5.2f, max depth %3d, full on %3.0f%% of %d puts' % (
+            name, metrics[name]['mean_depth'], metrics[name]['max_depth'],
+            100 * metrics[name]['full'], metrics[name]['puts']))
+    return '\n'.join(lines)
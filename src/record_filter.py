@@ -0,0 +1,93 @@
+"""Record Filter
+
+This module restricts the analysis to a subset of the donations, e.g. a few
+committees, zip codes or years. The filter works on the raw fields of a line,
+before the line is validated, so that irrelevant lines cost as little as
+possible.
+
+Not every line outside of the filter can be dropped, though. Whether a
+donation comes from a repeated donor depends on the donor's earliest
+donation, which may well have gone to another committee or happened in an
+earlier year. classify therefore sorts every line into one of three classes:
+
+    SKIP:       the line can not influence the output and is dropped.
+                This is the case for lines whose five digit zip code does
+                not match the given prefixes (the donor key contains the
+                five digit zip code) and for lines after the last year
+                (they can never be a donor's earliest donation before a
+                year we report on).
+    DONOR_ONLY: the line is not reported on, but it may still be the donor's
+                earliest donation, see repeated_donor_analysis.needs_donor_update.
+                This includes lines that only differ from a prefix longer
+                than five characters after the fifth digit.
+    KEEP:       the line is processed as without a filter
+
+"""
+
+SKIP = 0
+DONOR_ONLY = 1
+KEEP = 2
+
+
+class RecordFilter:
+    """ Decides on the raw fields of a line whether it is relevant for the analysis
+
+    Every criterion is optional, a line passes the filter if it meets all
+    given criteria.
+
+    Args:
+        cmte_ids (iterable): CMTE_IDs of the recipients to report on
+        zip_prefixes (iterable): prefixes of the zip codes to report on
+        years (tuple): first and last year (inclusive) to report on
+        min_amount (int): smallest $-amount of a donation to report on
+
+    """
+
+    def __init__(self, cmte_ids=None, zip_prefixes=None, years=None, min_amount=None):
+        self.cmte_ids = None if cmte_ids is None else frozenset(cmte_ids)
+        self.zip_prefixes = None if zip_prefixes is None else tuple(zip_prefixes)
+        # Donors are identified by the first five digits, so only these decide whether to skip
+        self.donor_zip_prefixes = None if zip_prefixes is None else tuple(
+            prefix[:5] for prefix in zip_prefixes)
+        self.first_year = None if years is None else years[0]
+        self.last_year = None if years is None else years[1]
+        self.min_amount = min_amount
+
+    def classify(self, entry):
+        """ Given the fields of a line, returns SKIP, DONOR_ONLY or KEEP
+
+        Lines that will certainly fail validation (wrong number of fields,
+        no year at the end of the date) are classified as SKIP.
+
+        Args:
+            entry (list): list containing the details of the donation from the original
+                file
+
+        Return:
+            int: SKIP, DONOR_ONLY or KEEP
+
+        """
+        if len(entry) != 21:
+            return SKIP
+        if self.zip_prefixes is not None and not entry[10].startswith(self.donor_zip_prefixes):
+            return SKIP
+        year = entry[13][-4:]
+        if len(year) != 4 or not year.isdecimal():
+            return SKIP
+        year = int(year)
+        if self.last_year is not None and year > self.last_year:
+            return SKIP
+        if self.first_year is not None and year < self.first_year:
+            return DONOR_ONLY
+        if self.zip_prefixes is not None and not entry[10].startswith(self.zip_prefixes):
+            return DONOR_ONLY
+        if self.cmte_ids is not None and entry[0] not in self.cmte_ids:
+            return DONOR_ONLY
+        if self.min_amount is not None:
+            try:
+                if int(entry[14]) < self.min_amount:
+                    return DONOR_ONLY
+            except ValueError:
+                # leave malformed amounts to the validation
+                return KEEP
+        return KEEP
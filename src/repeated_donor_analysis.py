@@ -7,7 +7,10 @@ to donors from a given zip code to a fixed recipient.
 
 
 Example:
-        $ python repeated_donor_analysis.py input_file output_file percentile
+        $ python repeated_donor_analysis.py input_file percentile_file output_file [format]
+
+    The optional format selects the output sink (text, csv, columnar or
+    sqlite, see output_sinks), it defaults to the pipe-delimited text format.
 
 Attributes:
     repeat_donors (dict): stores a donor's (identified by name and zip-code)
@@ -15,18 +18,34 @@ Attributes:
         comes from a repeated donor in constant time
     recipients (dict): stores the $-amount of donations
         under the key (recipient, zip-code, year). The values are stored in a
-        sorted list to allow for efficient percentile computations.
+        sorted list to allow for efficient percentile computations. Lists
+        that grow very large are replaced by a HotBucket (see hot_buckets).
+    totals (dict): stores the running total $-amount of the donations under
+        the same keys as recipients, so that it never has to be summed up.
+    bucket_stats (dict): counts how many lists were promoted to a HotBucket
+        and how many donations a HotBucket kept outside of its tree as outliers.
+    transactions (dict): only used when duplicates are removed. Stores for
+        every transaction (identified by CMTE_ID and TRAN_ID) the key in
+        recipients and the $-amount it was counted with, or None if it was
+        not counted. This allows skipping repeated rows and replacing the
+        amount of amended transactions.
 
 """
 
 import sys
 import math
 import datetime
-import re
 from sortedcontainers import SortedList
+import hot_buckets
+from hot_buckets import HotBucket
+from output_sinks import Record, TextSink, format_record, make_sink
+from record_filter import SKIP, DONOR_ONLY, KEEP
 
 repeat_donors = {}
 recipients = {}
+totals = {}
+bucket_stats = {'promoted': 0, 'outliers': 0}
+transactions = {}
 
 
 def main():
@@ -34,7 +53,8 @@ def main():
     
     The function reads three inputs from the command line:
     input file, output file and a file containing a single
-    integer, the percentile value. It checks that there are
+    integer, the percentile value. An optional fourth argument
+    names the output format. It checks that there are
     enough arguments and passes them on to the reader.
     
     Args:
@@ -42,66 +62,142 @@ def main():
     Returns:
     
     """
-    if len(sys.argv) > 3:
+    if len(sys.argv) > 4:
+        sink = make_sink(sys.argv[4], sys.argv[3])
+        if sink is None:
+            print("Unknown output format " + sys.argv[4])
+            return
+        process_file(sys.argv[1], sys.argv[2], sys.argv[3], sink)
+    elif len(sys.argv) > 3:
         process_file(sys.argv[1], sys.argv[2], sys.argv[3])
 
 
-def process_file(input_file_path, percentile_file_path,  output_file_path):
+def reset():
+    """ Forgets all donors and recipients seen so far
+
+    process_file accumulates its results in the module variables repeat_donors
+    and recipients. A process that analyses several independent files, such as
+    the worker in cli.py, calls this function before each of them.
+
+    Args:
+
+    Return:
+
+    """
+    repeat_donors.clear()
+    recipients.clear()
+    totals.clear()
+    bucket_stats['promoted'] = 0
+    bucket_stats['outliers'] = 0
+    transactions.clear()
+
+
+def process_file(input_file_path, percentile_file_path,  output_file_path, sink=None,
+                 record_filter=None, deduplicate=False):
     """ Given a percentile, an input and an output file, computes percentiles of donations
 
     The function reads the input file sequentually and saves repeated donors.
     If a line contains donation from a repeated donor, then for the recipients
     donations from repeated donors from this zip code, the percentile value is
-    computed and the information is stored in the output_content strin.
-    After having processed the input file, output_content is written into the
-    output_file_path.
+    computed and the resulting record is written to the sink.
+    By default, the sink collects the records in the pipe-delimited text
+    format and writes them into output_file_path once the input file
+    has been processed.
+    If a record_filter is given, lines it classifies as irrelevant are skipped
+    before validation. Lines that are only relevant for a donor's earliest
+    donation are only validated if they would update repeat_donors.
     
     Args:
         input_file_path (string): A string with the path to the input file
         percentile_file_path (string): A string with the path to the
             file that contains the percentile value
         output_file_path (string): A string with the path to the output file
+        sink: optional sink from output_sinks that receives the records,
+            a TextSink writing to output_file_path is used if none is given.
+            It is closed once all records are written, or discarded if the
+            analysis fails.
+        record_filter (RecordFilter): optional filter restricting the
+            donations that are reported on, see record_filter
+        deduplicate (boolean): if True, repeated rows of a transaction are
+            skipped and amendments replace the transaction's earlier amount,
+            see add_transaction
     
     Return:
+        boolean: True if the output was written, False if the percentile was
+            not an integer or the files could not be read or written
     
     """
     print(input_file_path)
     print(percentile_file_path)
     print(output_file_path)
+    if sink is None:
+        sink = TextSink(output_file_path)
+    closed = False
     try:
-        # Read percentile value and convert it to integer
-        percentile_file = open(percentile_file_path, 'r')
-    
-        try:
-            percentile = int(percentile_file.readline())
-        except ValueError:
-            print("Percentile was not an integer")
-            return
-        percentile_file.close()
-
-        # Store output in variable, slightly faster then dumping lines individually
-        output_content = ''
+        percentile = read_percentile(percentile_file_path)
+        if percentile is None:
+            return False
 
         # Process evert line of input file
         with open(input_file_path, 'r') as input_file:
             for line in input_file:
                 entry = line.split('|')
+                if record_filter is not None:
+                    action = record_filter.classify(entry)
+                    if deduplicate and action != KEEP:
+                        # an amendment may move a transaction out of the filter
+                        withdraw_transaction(amendment_of(entry))
+                    if action == SKIP:
+                        continue
+                    if action == DONOR_ONLY:
+                        if needs_donor_update(entry) and is_valid(entry):
+                            add_donor(extract(entry))
+                        continue
                 if is_valid(entry):
                     # extract relevant details of donation
                     donation = extract(entry)
+                    # skip repeated rows, take back the earlier amount of amendments
+                    transaction = transaction_of(entry) if deduplicate else None
+                    if not add_transaction(transaction):
+                        continue
                     # update donors information in repeat_donor
                     add_donor(donation)
                     # check if donation is from repeated donor, return recipient
                     recipient_key = add_recipients(donation)
+                    record_transaction(transaction, recipient_key, donation[4])
                     if recipient_key is not None:
-                        output_content += format_entry(percentile, recipient_key)
-                        output_content += "\n"
-            # Save output to file
-            output_file = open(output_file_path, 'w+')
-            output_file.write(output_content)
-            output_file.close()
+                        sink.write(summarize(percentile, recipient_key))
+            # Save output to the sink's destination
+            sink.close()
+            closed = True
     except IOError:
         print("There was an error reading/writing the files.")
+    finally:
+        # Release the sink's file or connection if the output is incomplete
+        if not closed:
+            sink.discard()
+    return closed
+
+
+def read_percentile(percentile_file_path):
+    """ Reads the percentile value from the first line of the given file
+
+    IOErrors are not handled, they are passed on to the caller.
+
+    Args:
+        percentile_file_path (string): A string with the path to the
+            file that contains the percentile value
+
+    Return:
+        percentile (int): the percentile value, None if it was not an integer
+
+    """
+    with open(percentile_file_path, 'r') as percentile_file:
+        try:
+            return int(percentile_file.readline())
+        except ValueError:
+            print("Percentile was not an integer")
+            return None
 
 
 def format_entry(percentile, recipient_key):
@@ -120,15 +216,26 @@ def format_entry(percentile, recipient_key):
         line (string): a string summarizing the recipients donations
             from the zip code in the given year.
     
+    """
+    return format_record(summarize(percentile, recipient_key))
+
+
+def summarize(percentile, recipient_key):
+    """ Given a percentile and (recipient,zip-code,year) key, returns the output record
+
+    Args:
+        percentile (int): percentile value that is computed
+        recipient_key (tuple): A tuple of the form (recipient, zip-code, year),
+            this is the key to the record we want to compute the percentile of.
+
+    Return:
+        record (Record): the typed record (recipient, zip-code, year,
+            percentile value, total amount, number of contributions)
+
     """
     percentile_value, count = percentile_count(percentile, recipient_key)
-    entry = recipients[recipient_key]
-    amount = sum(entry)
-    line = recipient_key[0] + '|' + recipient_key[1] + '|'
-    line += str(recipient_key[2]) + '|'
-    line += str(percentile_value) + '|' + str(amount) + '|'
-    line += str(count)
-    return line
+    return Record(recipient_key[0], recipient_key[1], recipient_key[2],
+                  percentile_value, totals[recipient_key], count)
 
 
 def percentile_count(percentile, recipient_key):
@@ -211,13 +318,10 @@ def is_valid(entry):
     if entry[15] != '':
         return False
     # Check if date is malformed
-    try:
-        datetime.datetime.strptime(entry[13], '%m%d%Y')
-    except ValueError:
+    if not is_valid_date(entry[13]):
         return False
-    # Check if zip code is malformed
-    is_zip = re.compile(r'\d{5}.*')
-    if is_zip.match(entry[10]) is None:
+    # Check if zip code is malformed, i.e. does not start with five digits
+    if len(entry[10]) < 5 or not entry[10][:5].isdecimal():
         return False
     # check if name is malformed
     if entry[7] == '' or len(entry[7].split(",")) < 2:
@@ -228,6 +332,30 @@ def is_valid(entry):
     return True
 
 
+def is_valid_date(date):
+    """ Checks if date is a valid date in the format MMDDYYYY
+
+    Dates with eight digits are checked directly, this avoids the cost of
+    loading and running strptime for every entry. Other strings are passed
+    on to strptime, which also accepts e.g. single digit months.
+
+    Args:
+        date (string): the TRANSACTION_DT field of an entry
+
+    Return:
+        boolean: True if date is valid, False otherwise
+
+    """
+    try:
+        if len(date) == 8 and date.isdecimal():
+            datetime.date(int(date[4:]), int(date[:2]), int(date[2:4]))
+        else:
+            datetime.datetime.strptime(date, '%m%d%Y')
+    except ValueError:
+        return False
+    return True
+
+
 def add_donor(entry):
     """ If this is the donors earliest donation, then it saves the year of this donation under the donor's key
 
@@ -254,6 +382,27 @@ def add_donor(entry):
         repeat_donors[donor_key] = entry[3]
 
 
+def needs_donor_update(entry):
+    """ Checks on the raw fields of a line whether it could change repeat_donors
+
+    A donation only changes repeat_donors if the donor is unknown or the
+    donation is from an earlier year than the donor's earliest donation so far.
+    Only the key and the year are looked at, the entry still has to be validated.
+    The entry needs to have 21 fields and a date that ends with four digits,
+    as ensured by RecordFilter.classify.
+
+    Args:
+        entry (list): list containing the details of the donation from the original
+            file
+
+    Return:
+        boolean: True if the donation could update repeat_donors, False otherwise
+
+    """
+    first_year = repeat_donors.get(entry[7] + entry[10][:5])  # name+zip
+    return first_year is None or first_year > int(entry[13][-4:])
+
+
 def add_recipients(entry):
     """ Checks if donation is from repeated donor and adds it to recipient list.
 
@@ -263,6 +412,8 @@ def add_recipients(entry):
     The value associated is a sorted list of the $-amount of the donations.
     The sorted list is used adding to it has amortized constant time complexity
     and a sorted list allows for fast percentile computation.
+    Once a list holds hot_buckets.PROMOTION_SIZE donations, it is promoted to
+    a HotBucket, see add_amount.
     
     Args:
         entry (list): list containing the details of the donation,
@@ -281,12 +432,174 @@ def add_recipients(entry):
         # store donation amount under (recipient, zip, year)
         recip_key = (entry[0], entry[2], entry[3])
         if recip_key in recipients:
-            recipients[recip_key].add(entry[4])
+            add_amount(recip_key, entry[4])
         else:
             recipients[recip_key] = SortedList([entry[4]])
+            totals[recip_key] = entry[4]
     return recip_key
 
 
+def add_amount(recipient_key, amount):
+    """ Adds the $-amount to an existing entry of recipients, switching its representation if needed
+
+    A sorted list that reaches hot_buckets.PROMOTION_SIZE donations is
+    replaced by a HotBucket, which adds donations faster. Promotions and the
+    amounts a HotBucket keeps as outliers are counted in bucket_stats.
+
+    Args:
+        recipient_key (tuple): A tuple of the form (recipient, zip-code, year)
+        amount (int): the $-amount of the donation
+
+    Return:
+        No return value
+
+    """
+    entry = recipients[recipient_key]
+    totals[recipient_key] += amount
+    if isinstance(entry, HotBucket):
+        if not entry.add(amount):
+            bucket_stats['outliers'] += 1
+    else:
+        entry.add(amount)
+        if len(entry) >= hot_buckets.PROMOTION_SIZE:
+            entry = HotBucket(entry)
+            recipients[recipient_key] = entry
+            bucket_stats['promoted'] += 1
+            bucket_stats['outliers'] += len(entry.outliers)
+
+
+def transaction_of(entry):
+    """ Given a valid entry, returns the key of its transaction and whether it is an amendment
+
+    A transaction is identified by the CMTE_ID of the recipient and its
+    TRAN_ID (field 16), which is kept when a filing is amended. The
+    AMNDT_IND (field 1) of an amendment is 'A'.
+
+    Args:
+        entry (list): list containing the details of a valid donation
+            from the original file
+
+    Return:
+        transaction (tuple): (key, amended) with the key as a string and amended
+            as a boolean. None if the entry has no TRAN_ID.
+
+    """
+    if entry[16] == '':
+        return None
+    return entry[0] + '|' + entry[16], entry[1] == 'A'
+
+
+def add_transaction(transaction):
+    """ Checks if a transaction has to be counted and takes back the earlier amount of amendments
+
+    The first row of a transaction is always counted. Later rows of the same
+    transaction are skipped, unless they are amendments. In that case, the
+    amount the transaction was counted with so far is removed from its
+    recipient's sorted list, so that the amended amount replaces it.
+    The caller counts the row and stores the result via record_transaction.
+
+    Args:
+        transaction (tuple): (key, amended) as returned by transaction_of,
+            None if duplicates are not removed
+
+    Return:
+        boolean: True if the row has to be counted, False if it is a repeated row
+
+    """
+    if transaction is None:
+        return True
+    key, amended = transaction
+    if key not in transactions:
+        transactions[key] = None
+        return True
+    if not amended:
+        return False
+    earlier = transactions[key]
+    if earlier is not None:
+        remove_recipient(earlier[0], earlier[1])
+        transactions[key] = None
+    return True
+
+
+def amendment_of(entry):
+    """ Given the fields of a line, returns its transaction if it is a valid amendment
+
+    Used for lines outside of a record filter, which are not counted, but
+    still have to take back the earlier amount of the transaction they amend.
+
+    Args:
+        entry (list): list containing the details of the donation from the original
+            file
+
+    Return:
+        transaction (tuple): (key, True) as returned by transaction_of, None if
+            the line is not a valid amendment with a TRAN_ID
+
+    """
+    if len(entry) != 21 or entry[1] != 'A' or entry[16] == '' or not is_valid(entry):
+        return None
+    return transaction_of(entry)
+
+
+def withdraw_transaction(transaction):
+    """ Takes back the amount a transaction was counted with, without counting it again
+
+    This is what add_transaction does for an amendment, for amendments that
+    are not counted themselves because they lie outside of the record filter.
+
+    Args:
+        transaction (tuple): (key, amended) as returned by transaction_of, or None
+
+    Return:
+        No return value
+
+    """
+    if transaction is None:
+        return
+    earlier = transactions.get(transaction[0])
+    if earlier is not None:
+        remove_recipient(earlier[0], earlier[1])
+        transactions[transaction[0]] = None
+
+
+def record_transaction(transaction, recipient_key, amount):
+    """ Stores where the amount of a transaction was counted, so an amendment can take it back
+
+    Args:
+        transaction (tuple): (key, amended) as returned by transaction_of, or None
+        recipient_key (tuple): the key returned by add_recipients, None if
+            the amount was not counted
+        amount (int): the $-amount that was counted
+
+    Return:
+        No return value
+
+    """
+    if transaction is not None and recipient_key is not None:
+        transactions[transaction[0]] = (recipient_key, amount)
+
+
+def remove_recipient(recipient_key, amount):
+    """ Removes one donation of the given $-amount from the recipient's sorted list
+
+    The list and its total are removed if it becomes empty.
+
+    Args:
+        recipient_key (tuple): A tuple of the form (recipient, zip-code, year)
+        amount (int): the $-amount of the donation
+
+    Return:
+        No return value
+
+    """
+    entry = recipients[recipient_key]
+    entry.remove(amount)
+    totals[recipient_key] -= amount
+    if not entry:
+        del recipients[recipient_key]
+        del totals[recipient_key]
+
+
 # Only run main if module is executed as main
 if __name__ == "__main__":
     main()
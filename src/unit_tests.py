@@ -1,6 +1,21 @@
 import repeated_donor_analysis as ra
+import output_sinks
+import record_filter
+import pipeline
+import hot_buckets
+import cli
+import benchmark
 from sortedcontainers import SortedList
+import os
+import json
+import random
+import sqlite3
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 
 class TestRepeatedDonorAnalysisMethods(unittest.TestCase):
@@ -34,6 +49,17 @@ class TestRepeatedDonorAnalysisMethods(unittest.TestCase):
         self.assertFalse(ra.is_valid(cmte_error))
         self.assertFalse(ra.is_valid(amt_error))
         self.assertFalse(ra.is_valid(length_error))
+
+    def test_is_valid_date(self):
+        """ Checks if dates are validated like strptime with the format MMDDYYYY"""
+        self.assertTrue(ra.is_valid_date('08232017'))
+        self.assertTrue(ra.is_valid_date('02292016'))
+        self.assertTrue(ra.is_valid_date('1232017'))
+        self.assertFalse(ra.is_valid_date('02292017'))
+        self.assertFalse(ra.is_valid_date('13012017'))
+        self.assertFalse(ra.is_valid_date('00012017'))
+        self.assertFalse(ra.is_valid_date('0823201a'))
+        self.assertFalse(ra.is_valid_date(''))
         
     def test_add_recipient(self):
         """ Checks if recipients are only added from repeated donors"""
@@ -64,6 +90,42 @@ class TestRepeatedDonorAnalysisMethods(unittest.TestCase):
         ra.add_donor(entry3)
         self.assertEqual(ra.repeat_donors, {'Wurst, Hans30034': 2017, 'Haase, Bastian30033': 2017})
 
+    def test_needs_donor_update(self):
+        """ Checks if only unknown donors and earlier donations lead to an update"""
+        ra.repeat_donors = {'JEROME, CHRISTOPHER30033': 2017}
+        entry = 'CMTE_ID|1|2|3|4|5|6|JEROME, CHRISTOPHER|8|9|300331234|11|12|08232017|40||16|17|18|19|20'.split('|')
+        self.assertFalse(ra.needs_donor_update(entry))
+        entry[13] = '08232016'
+        self.assertTrue(ra.needs_donor_update(entry))
+        entry[13] = '08232017'
+        entry[7] = 'HAASE, BASTIAN'
+        self.assertTrue(ra.needs_donor_update(entry))
+
+    def test_add_transaction(self):
+        """ Checks if repeated rows are skipped and amendments replace the earlier amount"""
+        ra.recipients = {('test_rec', '30033', 2018): SortedList([100, 250])}
+        ra.totals = {('test_rec', '30033', 2018): 350}
+        ra.transactions = {}
+        self.assertTrue(ra.add_transaction(None))
+        self.assertTrue(ra.add_transaction(('test_rec|SA1', False)))
+        ra.record_transaction(('test_rec|SA1', False), ('test_rec', '30033', 2018), 100)
+        self.assertFalse(ra.add_transaction(('test_rec|SA1', False)))
+        self.assertTrue(ra.add_transaction(('test_rec|SA1', True)))
+        self.assertEqual(ra.recipients, {('test_rec', '30033', 2018): SortedList([250])})
+        self.assertEqual(ra.transactions, {'test_rec|SA1': None})
+        self.assertTrue(ra.add_transaction(('test_rec|SA2', True)))
+        ra.remove_recipient(('test_rec', '30033', 2018), 250)
+        self.assertEqual(ra.recipients, {})
+
+    def test_transaction_of(self):
+        """ Checks if transactions are identified by CMTE_ID and TRAN_ID"""
+        entry = 'CMTE_ID|A|2|3|4|5|6|JEROME, CHRISTOPHER|8|9|30033|11|12|08232017|40||SA1|17|18|19|20'.split('|')
+        self.assertEqual(ra.transaction_of(entry), ('CMTE_ID|SA1', True))
+        entry[1] = 'N'
+        self.assertEqual(ra.transaction_of(entry), ('CMTE_ID|SA1', False))
+        entry[16] = ''
+        self.assertIsNone(ra.transaction_of(entry))
+
     def test_extract(self):
         """ checks if extract method ectracts the correct information"""
         correct_entry = 'CMTE_ID|1|2|3|4|5|6|JEROME, CHRISTOPHER|8|9|30033|11|12|08232017|40||16|17|18|19|20'.split('|')
@@ -88,11 +150,531 @@ class TestRepeatedDonorAnalysisMethods(unittest.TestCase):
     def test_format_entry(self):
         """ Checks if our output format works correctly"""
         ra.recipients = {('test', '30033', 2017): SortedList([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])}
+        ra.totals = {('test', '30033', 2017): 55}
         formatted = 'test|30033|2017|3|55|10'
         self.assertEqual(formatted, ra.format_entry(30, ('test', '30033', 2017)))
 
 
+class TestOutputSinks(unittest.TestCase):
+    """
+    This class tests the sinks defined in output_sinks.py
+
+    Every sink receives the same records, we then read back what the sink wrote
+    and compare it with the original records.
+
+    """
+
+    records = [output_sinks.Record('C00384516', '02895', 2018, 333, 333, 1),
+               output_sinks.Record('C00384516', '02895', 2018, 333, 717, 2)]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'output')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_records(self, sink):
+        for record in self.records:
+            sink.write(record)
+        sink.close()
+
+    def test_text_sink(self):
+        """ Checks if the text sink writes the format of the challenge"""
+        self.write_records(output_sinks.TextSink(self.path))
+        with open(self.path) as output_file:
+            self.assertEqual(output_file.read(), 'C00384516|02895|2018|333|333|1\nC00384516|02895|2018|333|717|2\n')
+
+    def test_columnar_sink(self):
+        """ Checks if the columnar file can be read back, also across several row groups"""
+        self.write_records(output_sinks.ColumnarSink(self.path, row_group_size=1))
+        columns = output_sinks.read_columnar(self.path)
+        self.assertEqual(columns['zip_code'], ['02895', '02895'])
+        self.assertEqual(columns['total_amount'], [333, 717])
+        self.assertEqual([output_sinks.Record(*row) for row in zip(*columns.values())], self.records)
+
+    def test_sqlite_sink(self):
+        """ Checks if all records end up in the table, also if the last batch is incomplete"""
+        self.write_records(output_sinks.SQLiteSink(self.path, batch_size=3))
+        connection = sqlite3.connect(self.path)
+        rows = connection.execute('SELECT * FROM repeat_donors').fetchall()
+        connection.close()
+        self.assertEqual(rows, [tuple(record) for record in self.records])
+
+    def test_sqlite_sink_replace(self):
+        """ Checks if a second run replaces the table by default and appends to it if asked to"""
+        self.write_records(output_sinks.SQLiteSink(self.path))
+        self.write_records(output_sinks.SQLiteSink(self.path))
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM repeat_donors').fetchone()[0], 2)
+        connection.close()
+        self.write_records(output_sinks.SQLiteSink(self.path, replace=False))
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM repeat_donors').fetchone()[0], 4)
+        connection.close()
+
+    def test_sqlite_sink_discard(self):
+        """ Checks if a failed run leaves an existing table as it was and creates no partial one"""
+        sink = output_sinks.SQLiteSink(self.path, batch_size=2)
+        for record in self.records * 3:
+            sink.write(record)
+        sink.discard()
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'repeat_donors'")
+                         .fetchone()[0], 0)
+        connection.close()
+        self.write_records(output_sinks.SQLiteSink(self.path))
+        sink = output_sinks.SQLiteSink(self.path, batch_size=2)
+        for record in self.records * 3:
+            sink.write(record)
+        sink.discard()
+        connection = sqlite3.connect(self.path)
+        rows = connection.execute('SELECT * FROM repeat_donors').fetchall()
+        connection.close()
+        self.assertEqual(rows, [tuple(record) for record in self.records])
+
+    def test_iterator_sink(self):
+        """ Checks if the iterator sink queues records or passes them to the consumer"""
+        sink = output_sinks.IteratorSink()
+        self.write_records(sink)
+        self.assertEqual(list(sink), self.records)
+        self.assertEqual(list(sink), [])
+        consumed = []
+        self.write_records(output_sinks.IteratorSink(consumed.append))
+        self.assertEqual(consumed, self.records)
+
+    def test_empty_output(self):
+        """ Checks if closing sinks without records writes valid empty outputs"""
+        output_sinks.ColumnarSink(self.path).close()
+        self.assertEqual(output_sinks.read_columnar(self.path)['count'], [])
+        output_sinks.SQLiteSink(self.path + '.db').close()
+        connection = sqlite3.connect(self.path + '.db')
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM repeat_donors').fetchone()[0], 0)
+        connection.close()
+
+    def test_discard(self):
+        """ Checks if process_file releases the sink when it can not complete the output"""
+        percentile_path = os.path.join(self.directory.name, 'percentile.txt')
+        input_path = os.path.join(self.directory.name, 'itcont.txt')
+        with open(percentile_path, 'w') as percentile_file:
+            percentile_file.write('thirty\n')
+        sink = output_sinks.ColumnarSink(self.path)
+        ra.process_file(input_path, percentile_path, self.path, sink)
+        self.assertIsNone(sink.output_file)
+        self.assertFalse(os.path.exists(self.path))
+        with open(percentile_path, 'w') as percentile_file:
+            percentile_file.write('30\n')
+        with open(input_path, 'w') as input_file:
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012017|100||||||\n')
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012018|200||||||\n')
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012018|1.5||||||\n')
+        for module in [ra, pipeline]:
+            sink = output_sinks.CSVSink(self.path)
+            ra.reset()
+            with self.assertRaises(ValueError):
+                module.process_file(input_path, percentile_path, self.path, sink)
+            self.assertIsNone(sink.output_file)
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_make_sink(self):
+        """ Checks if output formats are mapped to the right sinks"""
+        sink = output_sinks.make_sink('csv', self.path)
+        self.assertIsInstance(sink, output_sinks.CSVSink)
+        sink.close()
+        self.assertIsNone(output_sinks.make_sink('xml', self.path))
+
+
+class TestRecordFilter(unittest.TestCase):
+    """
+    This class tests the filter defined in record_filter.py
+
+    Besides the classification of single lines, we check that a filtered run
+    reports exactly the lines of a full run that pass the filter, even though
+    the donors' earliest donations are spread over all committees and years.
+
+    """
+
+    line = 'C1|1|2|3|4|5|6|JEROME, CHRISTOPHER|8|9|300331234|11|12|08232017|40||16|17|18|19|20'
+
+    def test_classify(self):
+        """ Checks if lines are skipped, only used for donors or kept as described"""
+        record = self.line.split('|')
+        everything = record_filter.RecordFilter()
+        self.assertEqual(everything.classify(record), record_filter.KEEP)
+        self.assertEqual(everything.classify(record[:20]), record_filter.SKIP)
+        self.assertEqual(record_filter.RecordFilter(zip_prefixes=['300']).classify(record), record_filter.KEEP)
+        self.assertEqual(record_filter.RecordFilter(zip_prefixes=['301']).classify(record), record_filter.SKIP)
+        self.assertEqual(record_filter.RecordFilter(zip_prefixes=['300331']).classify(record), record_filter.KEEP)
+        self.assertEqual(record_filter.RecordFilter(zip_prefixes=['300339']).classify(record), record_filter.DONOR_ONLY)
+        self.assertEqual(record_filter.RecordFilter(years=(2017, 2017)).classify(record), record_filter.KEEP)
+        self.assertEqual(record_filter.RecordFilter(years=(2015, 2016)).classify(record), record_filter.SKIP)
+        self.assertEqual(record_filter.RecordFilter(years=(2018, 2019)).classify(record), record_filter.DONOR_ONLY)
+        self.assertEqual(record_filter.RecordFilter(cmte_ids=['C2']).classify(record), record_filter.DONOR_ONLY)
+        self.assertEqual(record_filter.RecordFilter(min_amount=50).classify(record), record_filter.DONOR_ONLY)
+        record[13] = '0823201a'
+        self.assertEqual(everything.classify(record), record_filter.SKIP)
+
+    def test_filtered_run(self):
+        """ Checks if a filtered run reports the lines of a full run that pass the filter"""
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, 'itcont.txt')
+            percentile_path = os.path.join(directory, 'percentile.txt')
+            benchmark.generate_input(input_path, 5000)
+            with open(percentile_path, 'w') as percentile_file:
+                percentile_file.write('30\n')
+            full = output_sinks.IteratorSink()
+            ra.reset()
+            ra.process_file(input_path, percentile_path, None, full)
+            cmte_ids = {'C%08d' % index for index in range(0, 200, 3)}
+            expected = [record for record in full
+                        if record.recipient in cmte_ids and record.year == 2017]
+            filtered = output_sinks.IteratorSink()
+            ra.reset()
+            ra.process_file(input_path, percentile_path, None, filtered,
+                            record_filter.RecordFilter(cmte_ids=cmte_ids, years=(2017, 2017)))
+            self.assertGreater(len(expected), 0)
+            self.assertEqual(list(filtered), expected)
+
+            # A prefix longer than five digits must not skip the donor's other ZIP+4 codes
+            with open(input_path, 'w') as input_file:
+                input_file.write('C1|||||||HAASE, BASTIAN|||300339999|||01012016|100||||||\n')
+                input_file.write('C1|||||||HAASE, BASTIAN|||300331111|||01012017|200||||||\n')
+                input_file.write('C1|||||||HAASE, BASTIAN|||300331111|||01012018|300||||||\n')
+            filtered = output_sinks.IteratorSink()
+            ra.reset()
+            ra.process_file(input_path, percentile_path, None, filtered,
+                            record_filter.RecordFilter(zip_prefixes=['300331']))
+            self.assertEqual([record.year for record in filtered], [2017, 2018])
+
+
+class TestPipeline(unittest.TestCase):
+    """
+    This class tests the pipelined processing defined in pipeline.py
+
+    The pipelined version has to produce exactly the records of the sequential
+    version, for any block and batch size and number of parser workers.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, 'itcont.txt')
+        self.percentile_path = os.path.join(self.directory.name, 'percentile.txt')
+        benchmark.generate_input(self.input_path, 5000)
+        with open(self.percentile_path, 'w') as percentile_file:
+            percentile_file.write('30\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def compare(self, selection=None, deduplicate=False, **options):
+        expected = output_sinks.IteratorSink()
+        ra.reset()
+        ra.process_file(self.input_path, self.percentile_path, None, expected, selection, deduplicate)
+        records = output_sinks.IteratorSink()
+        ra.reset()
+        metrics = pipeline.process_file(self.input_path, self.percentile_path, None, records,
+                                        selection, deduplicate, **options)
+        self.assertEqual(list(records), list(expected))
+        return metrics
+
+    def test_same_output(self):
+        """ Checks if the pipeline computes the same records as process_file"""
+        metrics = self.compare(block_size=1000, batch_size=7, parser_workers=3, queue_size=2)
+        self.assertEqual(metrics['parse']['puts'], metrics['aggregate']['puts'])
+        self.assertLessEqual(metrics['parse']['max_depth'], 1)
+        self.compare(block_size=1 << 20, batch_size=10000, parser_workers=1)
+        self.compare(record_filter.RecordFilter(cmte_ids=['C00000001', 'C00000002'], years=(2016, 2017)),
+                     batch_size=50)
+
+    def test_filter_deduplicated(self):
+        """ Checks if an amendment that moves out of the filter takes back the earlier amount"""
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012017|10||SA0||||\n')
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012018|60||SA1||||\n')
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012018|100||SA2||||\n')
+            input_file.write('C1|A||||||HAASE, BASTIAN|||30033|||01012018|20||SA2||||\n')
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012018|80||SA3||||\n')
+        selection = record_filter.RecordFilter(min_amount=50)
+        for module in [ra, pipeline]:
+            records = output_sinks.IteratorSink()
+            ra.reset()
+            module.process_file(self.input_path, self.percentile_path, None, records, selection, True)
+            self.assertEqual([record.total_amount for record in records], [60, 160, 140])
+            self.assertEqual(ra.recipients[('C1', '30033', 2018)], SortedList([60, 80]))
+
+    def test_same_output_deduplicated(self):
+        """ Checks if the pipeline removes the same duplicates as process_file"""
+        benchmark.generate_input(self.input_path, 5000, repeated=0.1)
+        self.compare(deduplicate=True, batch_size=50)
+
+    def test_text_output(self):
+        """ Checks if the pipeline writes the expected file for the challenge's test"""
+        test_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'insight_testsuite',
+                                 'tests', 'test_1')
+        output_path = os.path.join(self.directory.name, 'repeat_donors.txt')
+        ra.reset()
+        pipeline.process_file(os.path.join(test_path, 'input', 'itcont.txt'),
+                              os.path.join(test_path, 'input', 'percentile.txt'), output_path)
+        with open(output_path) as output_file, \
+                open(os.path.join(test_path, 'output', 'repeat_donors.txt')) as expected_file:
+            self.assertEqual(output_file.read(), expected_file.read())
+
+    def test_error(self):
+        """ Checks if an error in a stage is raised instead of blocking the other stages"""
+        with open(self.input_path, 'a') as input_file:
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012017|1.5||||||\n')
+        ra.reset()
+        with self.assertRaises(ValueError):
+            pipeline.process_file(self.input_path, self.percentile_path, None,
+                                  output_sinks.IteratorSink(), batch_size=10, queue_size=1)
+
+
+class TestHotBuckets(unittest.TestCase):
+    """
+    This class tests HotBucket defined in hot_buckets.py and the promotion of buckets
+
+    A HotBucket has to behave exactly like a sorted list of the same amounts,
+    so we apply the same random operations to both and compare them.
+
+    """
+
+    def setUp(self):
+        self.promotion_size = hot_buckets.PROMOTION_SIZE
+
+    def tearDown(self):
+        hot_buckets.PROMOTION_SIZE = self.promotion_size
+
+    def test_same_as_sorted_list(self):
+        """ Checks if add, remove, len, indexing and iterating match a sorted list, outliers included"""
+        rand = random.Random(0)
+        values = [rand.randint(1, 100) for _ in range(300)]
+        bucket = hot_buckets.HotBucket(values)
+        expected = SortedList(values)
+        for _ in range(5000):
+            value = rand.choice([rand.randint(1, 100), rand.randint(-50, 5000), rand.randint(1, 100000)])
+            if rand.random() < 0.3 and value in expected:
+                bucket.remove(value)
+                expected.remove(value)
+            else:
+                bucket.add(value)
+                expected.add(value)
+        self.assertGreater(len(bucket.outliers), 0)
+        self.assertEqual(len(bucket), len(expected))
+        self.assertEqual(list(bucket), list(expected))
+        self.assertEqual([bucket[rank] for rank in range(len(bucket))], list(expected))
+        self.assertEqual(bucket[-1], expected[-1])
+
+    def test_errors(self):
+        """ Checks if missing amounts and invalid ranks are reported"""
+        bucket = hot_buckets.HotBucket([10, 20])
+        with self.assertRaises(ValueError):
+            bucket.remove(15)
+        with self.assertRaises(ValueError):
+            bucket.remove(5)
+        with self.assertRaises(IndexError):
+            bucket[2]
+        self.assertEqual(len(bucket), 2)
+
+    def test_memory_bound(self):
+        """ Checks if the tree stays in proportion to the number of donations and grows over the outliers"""
+        bucket = hot_buckets.HotBucket([1] * 255 + [1000000])
+        self.assertEqual(bucket.size, hot_buckets.MIN_SIZE)
+        self.assertEqual(list(bucket.outliers), [1000000])
+        self.assertFalse(bucket.add(hot_buckets.MIN_SIZE + 1))
+        for _ in range(512):
+            bucket.add(1)
+        self.assertTrue(bucket.add(hot_buckets.MIN_SIZE + 2))
+        self.assertEqual(bucket.size, 2 * hot_buckets.MIN_SIZE)
+        self.assertEqual(list(bucket.outliers), [1000000])
+        self.assertLessEqual(bucket.size, hot_buckets.SLOTS_PER_DONATION * len(bucket))
+
+    def test_add_amount(self):
+        """ Checks if large buckets are promoted and the total is kept without summing up the bucket"""
+        hot_buckets.PROMOTION_SIZE = 3
+        ra.reset()
+        ra.recipients[('test', '30033', 2018)] = SortedList([1, 2])
+        ra.totals[('test', '30033', 2018)] = 3
+        ra.add_amount(('test', '30033', 2018), 3)
+        bucket = ra.recipients[('test', '30033', 2018)]
+        self.assertIsInstance(bucket, hot_buckets.HotBucket)
+        self.assertEqual(ra.format_entry(50, ('test', '30033', 2018)), 'test|30033|2018|2|6|3')
+        # A single large donation after the promotion stays an outlier of the bucket
+        ra.add_amount(('test', '30033', 2018), 50000)
+        self.assertIs(ra.recipients[('test', '30033', 2018)], bucket)
+        self.assertEqual(ra.bucket_stats, {'promoted': 1, 'outliers': 1})
+        with mock.patch.object(hot_buckets.HotBucket, '__iter__', side_effect=AssertionError):
+            self.assertEqual(ra.format_entry(50, ('test', '30033', 2018)), 'test|30033|2018|2|50006|4')
+        ra.remove_recipient(('test', '30033', 2018), 50000)
+        self.assertEqual(ra.format_entry(100, ('test', '30033', 2018)), 'test|30033|2018|3|6|3')
+
+    def test_same_output(self):
+        """ Checks if promoting buckets does not change the output"""
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, 'itcont.txt')
+            percentile_path = os.path.join(directory, 'percentile.txt')
+            benchmark.generate_input(input_path, 5000, repeated=0.1)
+            with open(percentile_path, 'w') as percentile_file:
+                percentile_file.write('30\n')
+            expected = output_sinks.IteratorSink()
+            ra.reset()
+            ra.process_file(input_path, percentile_path, None, expected, None, True)
+            hot_buckets.PROMOTION_SIZE = 2
+            records = output_sinks.IteratorSink()
+            ra.reset()
+            ra.process_file(input_path, percentile_path, None, records, None, True)
+            self.assertGreater(ra.bucket_stats['promoted'], 0)
+            self.assertEqual(list(records), list(expected))
+
+
+class TestCommandLine(unittest.TestCase):
+    """
+    This class tests the modes defined in cli.py
+
+    The worker is started in a thread of the test process and receives the
+    jobs through a socket in a temporary directory.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, 'itcont.txt')
+        self.percentile_path = os.path.join(self.directory.name, 'percentile.txt')
+        self.output_path = os.path.join(self.directory.name, 'output.txt')
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012017|100||||||\n')
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012018|200||||||\n')
+        with open(self.percentile_path, 'w') as percentile_file:
+            percentile_file.write('50\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run_job(self):
+        """ Checks if a job is processed on fresh data structures and malformed jobs are reported"""
+        ra.repeat_donors = {'HAASE, BASTIAN30033': 2010}
+        job = cli.job_from_arguments([self.input_path, self.percentile_path, self.output_path])
+        self.assertEqual(cli.run_job(job)['status'], 'ok')
+        with open(self.output_path) as output_file:
+            self.assertEqual(output_file.read(), 'C1|30033|2018|200|200|1\n')
+        self.assertEqual(ra.repeat_donors, {})
+        self.assertEqual(cli.run_job({'input': self.input_path})['status'], 'error')
+        job['format'] = 'xml'
+        self.assertEqual(cli.run_job(job)['status'], 'error')
+        job['format'] = 'text'
+        job['filter'] = {'cmte_ids': ['C2']}
+        self.assertEqual(cli.run_job(job)['status'], 'ok')
+        with open(self.output_path) as output_file:
+            self.assertEqual(output_file.read(), '')
+        job['filter'] = {'committees': ['C2']}
+        self.assertEqual(cli.run_job(job)['status'], 'error')
+
+    def test_run_job_bucket_stats(self):
+        """ Checks if the response counts the promoted buckets of the job, not of the next one"""
+        with open(self.input_path, 'a') as input_file:
+            for amount in range(1, hot_buckets.PROMOTION_SIZE + 1):
+                input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012018|%d||||||\n' % amount)
+        job = cli.job_from_arguments([self.input_path, self.percentile_path, self.output_path])
+        response = cli.run_job(job)
+        self.assertEqual(response['status'], 'ok')
+        self.assertEqual(response['buckets'], {'promoted': 1, 'outliers': 0})
+        self.assertEqual(ra.bucket_stats, {'promoted': 0, 'outliers': 0})
+
+    def test_main_exit_status(self):
+        """ Checks if run and submit report failed jobs with exit status 1"""
+        arguments = ['cli.py', 'run', self.input_path, self.percentile_path, self.output_path]
+        with mock.patch('sys.argv', arguments):
+            cli.main()
+        for failing in [arguments + ['xml'], ['cli.py', 'run', self.output_path + '.missing',
+                                               self.percentile_path, self.output_path]]:
+            with mock.patch('sys.argv', failing), self.assertRaises(SystemExit) as raised:
+                cli.main()
+            self.assertEqual(raised.exception.code, 1)
+        with mock.patch('sys.argv', ['cli.py', 'submit', 'worker.sock'] + arguments[2:] + ['xml']), \
+                mock.patch('cli.submit', return_value={'status': 'error', 'message': 'Unknown output format xml'}), \
+                self.assertRaises(SystemExit) as raised:
+            cli.main()
+        self.assertEqual(raised.exception.code, 1)
+
+    def test_job_from_arguments(self):
+        """ Checks if jobs carry absolute paths, so a worker in another directory finds the files"""
+        job = cli.job_from_arguments(['itcont.txt', 'percentile.txt', 'output.txt'])
+        self.assertEqual(job['input'], os.path.join(os.getcwd(), 'itcont.txt'))
+        self.assertEqual(job['output'], os.path.join(os.getcwd(), 'output.txt'))
+        self.assertEqual(job['format'], 'text')
+
+    def test_run_job_deduplicate(self):
+        """ Checks if repeated rows are not reported and amendments replace the earlier amount"""
+        with open(self.input_path, 'a') as input_file:
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012018|300||SA2||||\n')
+            input_file.write('C1|N||||||HAASE, BASTIAN|||30033|||01012018|300||SA2||||\n')
+            input_file.write('C1|A||||||HAASE, BASTIAN|||30033|||01012018|50||SA2||||\n')
+        job = cli.job_from_arguments([self.input_path, self.percentile_path, self.output_path])
+        job['deduplicate'] = True
+        self.assertEqual(cli.run_job(job)['status'], 'ok')
+        with open(self.output_path) as output_file:
+            self.assertEqual(output_file.read().split('\n'), ['C1|30033|2018|200|200|1', 'C1|30033|2018|200|500|2',
+                                                               'C1|30033|2018|50|250|2', ''])
+
+    def test_serve_submit(self):
+        """ Checks if the worker answers several jobs and shuts down when asked to"""
+        socket_path = os.path.join(self.directory.name, 'worker.sock')
+        worker = threading.Thread(target=cli.serve, args=(socket_path,))
+        worker.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        job = cli.job_from_arguments([self.input_path, self.percentile_path, self.output_path, 'csv'])
+        for _ in range(2):
+            self.assertEqual(cli.submit(socket_path, job)['status'], 'ok')
+        with open(self.output_path) as output_file:
+            self.assertEqual(len(output_file.readlines()), 2)
+        # Failing jobs are reported and do not stop the worker
+        failing = dict(job, output=os.path.join(self.directory.name, 'missing', 'output.csv'))
+        self.assertEqual(cli.submit(socket_path, failing)['status'], 'error')
+        failing = dict(job, format='sqlite', output=self.directory.name)
+        self.assertEqual(cli.submit(socket_path, failing)['status'], 'error')
+        with open(self.input_path, 'a') as input_file:
+            input_file.write('C1|||||||HAASE, BASTIAN|||30033|||01012018|1.5||||||\n')
+        response = cli.submit(socket_path, job)
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('ValueError', response['message'])
+        self.assertEqual(cli.submit(socket_path, dict(job, input=self.percentile_path))['status'], 'ok')
+        self.assertEqual(cli.submit(socket_path, {'command': 'shutdown'})['status'], 'ok')
+        worker.join()
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_serve_disconnect(self):
+        """ Checks if the worker goes on after clients that disconnect early or send nothing"""
+        socket_path = os.path.join(self.directory.name, 'worker.sock')
+        timeout = cli.CONNECTION_TIMEOUT
+        cli.CONNECTION_TIMEOUT = 0.1
+        worker = threading.Thread(target=cli.serve, args=(socket_path,))
+        worker.start()
+        try:
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            job = cli.job_from_arguments([self.input_path, self.percentile_path, self.output_path])
+            # Send a job and go away without reading the answer
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+                client.sendall(json.dumps(job).encode('utf-8') + b'\n')
+            # Connect and send nothing
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+                self.assertEqual(cli.submit(socket_path, job)['status'], 'ok')
+            self.assertEqual(cli.submit(socket_path, {'command': 'shutdown'})['status'], 'ok')
+            worker.join()
+        finally:
+            cli.CONNECTION_TIMEOUT = timeout
+        self.assertFalse(os.path.exists(socket_path))
+
+
 # Run all tests
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestRepeatedDonorAnalysisMethods)
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestOutputSinks))
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestRecordFilter))
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPipeline))
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestHotBuckets))
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCommandLine))
 unittest.TextTestRunner(verbosity=2).run(suite)